@@ -1,31 +1,61 @@
 #!/usr/bin/env python3
 
 import click
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import dateutil.parser
+import functools
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from googleapiclient.model import JsonModel
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from google.oauth2.credentials import Credentials
+import json
+import orjson
 import os
-import pickle
 import polyinterface
 from polyinterface import LOGGER
-import pytz
+import threading
+import time
+from zoneinfo import ZoneInfo
 
 
 class Controller(polyinterface.Controller):
 
     SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+    TOKEN_FILE = 'token.json'
+    # Partial responses, only fields used by refresh and process_config
+    EVENT_FIELDS = ('items(id,status,summary,transparency,start/date,end/date),'
+        'nextSyncToken')
+    CALENDAR_FIELDS = 'etag,items(id,summary,timeZone),nextPageToken'
+    # Maximum page size allowed by calendarList.list
+    CALENDAR_PAGE_SIZE = 250
+    # Seconds between syncs when the day has not rolled over
+    SYNC_INTERVAL = 300
+    # Seconds before access token expiry to refresh it ahead of API calls
+    TOKEN_REFRESH_MARGIN = 300
+    # Google Calendar limit of requests in a single batch
+    MAX_BATCH_SIZE = 50
+    MAX_WORKERS = 8
 
     def __init__(self, polyglot):
         super(Controller, self).__init__(polyglot)
         self.calendars = []
         self.poly.onConfig(self.process_config)
-        self.calendarList = []
+        self.calendarDocs = None
         self.service = None
         self.credentials = None
         self.isStarted = False
         self.config = None
+        self.lock = threading.RLock()
+        self.refreshThread = None
+        self.pool = None
+        self.threadHttp = threading.local()
+        self.lastSync = None
+        self.calendarListETag = None
+        self.cachedCalendarList = {}
 
     def discover(self, *args, **kwargs):
         self.refresh()
@@ -53,14 +83,25 @@ class Controller(polyinterface.Controller):
         self.setDriver('ST', 1)
         LOGGER.info('Started HolidayGoogle Server')
 
-        if os.path.exists('token.pickle'):
+        self.pool = ThreadPoolExecutor(max_workers=Controller.MAX_WORKERS)
+
+        if os.path.exists(Controller.TOKEN_FILE):
+            with open(Controller.TOKEN_FILE) as token:
+                self.credentials = Credentials.from_authorized_user_info(
+                    json.loads(token.read()), Controller.SCOPES)
+        elif os.path.exists('token.pickle'):
+            # Convert token saved by previous versions
+            import pickle
             with open('token.pickle', 'rb') as token:
                 self.credentials = pickle.load(token)
+            self.saveCredentials()
+            os.remove('token.pickle')
 
         if not self.credentials or not self.credentials.valid:
             if (self.credentials and self.credentials.expired and
                 self.credentials.refresh_token):
                 self.credentials.refresh(Request())
+                self.saveCredentials()
             else:
                 self.flow = Flow.from_client_secrets_file(
                     'credentials.json', Controller.SCOPES,
@@ -81,50 +122,261 @@ class Controller(polyinterface.Controller):
             self.config = None
         self.refresh()
 
+    def saveCredentials(self):
+        with open(Controller.TOKEN_FILE, 'w') as token:
+            token.write(self.credentials.to_json())
+
     def openService(self):
-        self.service = build('calendar', 'v3', credentials=self.credentials)
+        self.service = build('calendar', 'v3', credentials=self.credentials,
+            model=OrjsonModel(), cache_discovery=False, static_discovery=True)
         LOGGER.debug('Google API Connection opened')
 
     def longPoll(self):
+        if self.needsRefresh():
+            target = self.pollRefresh
+        elif self.credentialsExpiring():
+            target = self.refreshCredentials
+        else:
+            return
+
+        if self.refreshThread is not None and self.refreshThread.is_alive():
+            LOGGER.debug('Previous refresh is still running')
+            return
+
+        self.refreshThread = threading.Thread(target=target, daemon=True)
+        self.refreshThread.start()
+
+    def credentialsExpiring(self):
+        if self.credentials is None or self.credentials.expiry is None:
+            return False
+
+        # Credentials expiry is naive UTC
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return ((self.credentials.expiry - now).total_seconds() <
+            Controller.TOKEN_REFRESH_MARGIN)
+
+    def refreshCredentials(self):
+        with self.lock:
+            if not self.credentialsExpiring():
+                return
+
+            try:
+                self.credentials.refresh(Request())
+                self.saveCredentials()
+                LOGGER.debug('Google API token refreshed')
+            except Exception as e:
+                LOGGER.error('Error refreshing token: %s', e)
+
+    def needsRefresh(self):
+        if (self.lastSync is None or
+            time.monotonic() - self.lastSync >= Controller.SYNC_INTERVAL):
+            return True
+
+        # Runs without the lock, config may add calendars while iterating
+        startDates = {}
+        for entry in self.calendars:
+            if entry.syncToken is None or entry.fetchTomorrow or entry.retry:
+                return True
+
+            startDate = startDates.get(entry.tz)
+            if startDate is None:
+                startDate = startDates[entry.tz] = self.getStartDate(entry.tz)
+            if startDate != entry.startDate:
+                return True
+
+        return False
+
+    def getStartDate(self, tz):
+        todayDate = datetime.datetime.now(tz)
+        return todayDate.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def getStartDates(self):
+        startDates = {}
+        for entry in self.calendars:
+            if entry.tz not in startDates:
+                startDates[entry.tz] = self.getStartDate(entry.tz)
+        return startDates
+
+    def pollRefresh(self):
         try:
             self.refresh()
         except Exception as e:
             LOGGER.error('Error refreshing calendars: %s', e)
 
     def refresh(self):
-        if not self.isStarted:
+        with self.lock:
+            self.refreshCalendars()
+
+    def refreshCalendars(self):
+        if not self.isStarted or not self.calendars:
             return
 
+        self.refreshCredentials()
+        startDates = self.getStartDates()
         for entry in self.calendars:
             calendar = entry.calendar
-            todayDate = datetime.datetime.now(pytz.timezone(calendar['timeZone']))
-            todayDate = todayDate.replace(hour=0, minute=0, second=0, microsecond=0)
+            todayDate = startDates[entry.tz]
             tomorrowDate = todayDate + datetime.timedelta(days=1 )
             LOGGER.debug(f'Checking calendar {calendar["summary"]} in time zone {calendar["timeZone"]} using date {todayDate}')
-            endDate = todayDate + datetime.timedelta(days=2)
             entry.todayNode.setDate(todayDate)
             entry.tomorrowNode.setDate(tomorrowDate)
-            result = self.service.events().list(calendarId=calendar['id'],
-                timeMin=todayDate.isoformat(), singleEvents=True,
-                timeMax=endDate.isoformat()).execute()
-            for event in result.get('items', []):
-                if self.is_holiday(event):
-                    LOGGER.debug(f'Event found {event["summary"]}, {event["start"]}, {event["end"]}')
-                    date = dateutil.parser.parse(event['start']['date']).date()
-
-                    if date == todayDate.date():
-                        entry.todayNode.setFutureState()
-                    else:
-                        entry.tomorrowNode.setFutureState()
-            entry.todayNode.refresh()
-            entry.tomorrowNode.refresh()
+            if entry.startDate != todayDate:
+                if (entry.syncToken is not None and
+                    entry.startDate + datetime.timedelta(days=1) == todayDate):
+                    # Today is already known, only the new tomorrow is fetched
+                    entry.holidays = {eventId: dates
+                        for eventId, dates in entry.holidays.items()
+                        if dates[1] > todayDate.date()}
+                    entry.fetchTomorrow = True
+                else:
+                    entry.syncToken = None
+                entry.startDate = todayDate
+            entry.updated = False
 
-    def is_holiday(self, event):
-        return (event.get('transparency') == 'transparent' and
-            'date' in event['start'] and
-            'date' in event['end'])
+        self.syncEvents(self.calendars)
+        expired = [entry for entry in self.calendars if entry.resync]
+        if len(expired) > 0:
+            self.syncEvents(expired)
+        self.lastSync = time.monotonic()
+
+        for entry in self.calendars:
+            if entry.updated:
+                self.updateNodes(entry)
+
+    def syncEvents(self, entries):
+        # Each entry sends up to two requests to a batch
+        size = Controller.MAX_BATCH_SIZE // 2
+        chunks = [entries[index:index + size]
+            for index in range(0, len(entries), size)]
+        if len(chunks) == 1:
+            self.syncBatch(chunks[0])
+            return
+
+        futures = [(chunk, self.pool.submit(self.syncBatch, chunk, True))
+            for chunk in chunks]
+        for chunk, future in futures:
+            exception = future.exception()
+            if exception is not None:
+                LOGGER.error('Error reading calendars %s: %s',
+                    ', '.join(entry.calendar['summary'] for entry in chunk),
+                    exception)
+                # Do full sync for failed calendars on next refresh
+                for entry in chunk:
+                    entry.syncToken = None
+
+    def getThreadHttp(self):
+        # httplib2 is not thread safe, each worker keeps its own connection
+        # open between refreshes
+        local = self.threadHttp
+        if getattr(local, 'credentials', None) is not self.credentials:
+            local.credentials = self.credentials
+            local.http = AuthorizedHttp(self.credentials, http=build_http())
+        return local.http
+
+    def syncBatch(self, entries, threaded=False):
+        batch = self.service.new_batch_http_request()
+        for entry in entries:
+            entry.resync = False
+            if entry.syncToken is not None:
+                batch.add(self.service.events().list(
+                    calendarId=entry.calendar['id'], singleEvents=True,
+                    syncToken=entry.syncToken,
+                    fields=Controller.EVENT_FIELDS),
+                    callback=functools.partial(self.onEvents, entry))
+                if entry.fetchTomorrow:
+                    batch.add(self.listEvents(entry, 1, 2),
+                        callback=functools.partial(self.onTomorrowEvents,
+                            entry))
+            else:
+                # Full sync covers tomorrow as well
+                batch.add(self.listEvents(entry, 0, 2),
+                    callback=functools.partial(self.onEvents, entry))
+                entry.fetchTomorrow = False
+        batch.execute(http=self.getThreadHttp() if threaded else None)
+
+    def listEvents(self, entry, startDay, endDay):
+        startDate = entry.startDate + datetime.timedelta(days=startDay)
+        endDate = entry.startDate + datetime.timedelta(days=endDay)
+        return self.service.events().list(
+            calendarId=entry.calendar['id'], singleEvents=True,
+            timeMin=startDate.isoformat(), timeMax=endDate.isoformat(),
+            fields=Controller.EVENT_FIELDS)
+
+    def onEvents(self, entry, requestId, result, exception):
+        if exception is not None:
+            if isinstance(exception, HttpError) and exception.resp.status == 410:
+                LOGGER.info('Sync token expired for calendar %s',
+                    entry.calendar['summary'])
+                entry.syncToken = None
+                entry.resync = True
+            else:
+                LOGGER.error('Error reading calendar %s: %s',
+                    entry.calendar['summary'], exception)
+                # Retry on next long poll instead of waiting for sync interval
+                entry.retry = True
+            return
+
+        if entry.syncToken is None:
+            entry.holidays = {}
+        self.applyEvents(entry, result)
+
+        # Missing when results are paged, full sync is done on next refresh
+        entry.syncToken = result.get('nextSyncToken')
+        entry.retry = False
+        entry.updated = True
+
+    def onTomorrowEvents(self, entry, requestId, result, exception):
+        if exception is not None:
+            LOGGER.error('Error reading calendar %s: %s',
+                entry.calendar['summary'], exception)
+            # Tomorrow is unknown, do full sync on next refresh
+            entry.syncToken = None
+            return
+
+        self.applyEvents(entry, result)
+        entry.fetchTomorrow = False
+
+    def applyEvents(self, entry, result):
+        # Holiday is a full day event that shows time as free
+        holidays = entry.holidays
+        fromisoformat = datetime.date.fromisoformat
+        for event in result.get('items', []):
+            get = event.get
+            if (get('status') == 'cancelled' or
+                get('transparency') != 'transparent'):
+                holidays.pop(get('id'), None)
+                continue
+
+            start = event['start']
+            end = event['end']
+            if 'date' not in start or 'date' not in end:
+                holidays.pop(get('id'), None)
+                continue
+
+            LOGGER.debug(f'Event found {get("summary")}, {start}, {end}')
+            # End date is exclusive
+            holidays[get('id')] = (fromisoformat(start['date']),
+                fromisoformat(end['date']))
+
+    def updateNodes(self, entry):
+        todayDate = entry.startDate.date()
+        tomorrowDate = todayDate + datetime.timedelta(days=1)
+        for startDate, endDate in entry.holidays.values():
+            if startDate <= todayDate < endDate:
+                entry.todayNode.setFutureState()
+            if (not entry.fetchTomorrow and
+                startDate <= tomorrowDate < endDate):
+                entry.tomorrowNode.setFutureState()
+        entry.todayNode.refresh()
+        # Tomorrow is not known until the new day is fetched
+        if not entry.fetchTomorrow:
+            entry.tomorrowNode.refresh()
 
     def process_config(self, config):
+        with self.lock:
+            self.processConfig(config)
+
+    def processConfig(self, config):
         if not self.isStarted:
             self.config = config
             return
@@ -141,9 +393,8 @@ class Controller(polyinterface.Controller):
 
             try:
                 self.flow.fetch_token(code=typedConfig.get('token'))
-                with open('token.pickle', 'wb') as token:
-                    pickle.dump(self.flow.credentials, token)
                 self.credentials = self.flow.credentials
+                self.saveCredentials()
                 self.openService()
                 self.removeNotice('auth')
             except Exception as e:
@@ -153,21 +404,12 @@ class Controller(polyinterface.Controller):
         LOGGER.debug('Reading calendar configuration')
         self.calendars = []
 
-        calendarList = {}
-        pageToken = None
-        while True:
-            list = self.service.calendarList().list(pageToken=pageToken).execute()
-            for listEntry in list['items']:
-                LOGGER.debug(f'Found calendar {listEntry["summary"]}')
-                calendarList[listEntry['summary']] = listEntry
-                pageToken = list.get('nextPageToken')
-            if not pageToken:
-                break
+        calendarList = self.readCalendarList()
 
-        list = typedConfig.get('calendarName')
+        names = typedConfig.get('calendarName')
         calendarIndex = 0
-        if list is not None:
-            for calendarName in list:
+        if names is not None:
+            for calendarName in names:
                 calendar = calendarList.get(calendarName)
                 if calendar is None:
                     LOGGER.error('Cannot find configured calendar name %s',
@@ -186,26 +428,78 @@ class Controller(polyinterface.Controller):
 
                     calendarIndex += 1
 
-        if calendarList.keys() != self.calendarList:
-            self.calendarList = calendarList.keys()
-            data = '<h3>Configured Calendars</h3><ul>'
-            for calendarName in self.calendarList:
-                data += '<li>' + calendarName + '</li>'
-            data += '</ul>'
+        data = ('<h3>Configured Calendars</h3><ul>' +
+            ''.join(f'<li>{calendarName}</li>' for calendarName in calendarList) +
+            '</ul>')
+        if data != self.calendarDocs:
+            self.calendarDocs = data
             self.poly.add_custom_config_docs(data, True)
 
         self.refresh()
 
+    def readCalendarList(self):
+        calendars = self.service.calendarList()
+        request = calendars.list(
+            maxResults=Controller.CALENDAR_PAGE_SIZE,
+            fields=Controller.CALENDAR_FIELDS)
+        if self.calendarListETag is not None:
+            request.headers['If-None-Match'] = self.calendarListETag
+
+        try:
+            page = request.execute()
+        except HttpError as e:
+            if e.resp.status == 304:
+                LOGGER.debug('Calendar list is not modified')
+                return self.cachedCalendarList
+            raise
+
+        etag = page.get('etag')
+        calendarList = {}
+        while True:
+            calendarList.update({listEntry['summary']: listEntry
+                for listEntry in page['items']})
+            pageToken = page.get('nextPageToken')
+            if not pageToken:
+                break
+            page = calendars.list(pageToken=pageToken,
+                maxResults=Controller.CALENDAR_PAGE_SIZE,
+                fields=Controller.CALENDAR_FIELDS).execute()
+        LOGGER.debug(f'Found calendars {", ".join(calendarList)}')
+
+        self.calendarListETag = etag
+        self.cachedCalendarList = calendarList
+        return calendarList
+
     id = 'controller'
     commands = { 'DISCOVER': discover, 'QUERY': query }
     drivers = [{ 'driver': 'ST', 'value': 0, 'uom': 2 }]
 
 
+class OrjsonModel(JsonModel):
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content
+
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+
 class CalendarEntry(object):
     def __init__(self, calendar, todayNode, tomorrowNode):
         self.calendar = calendar
+        self.tz = ZoneInfo(calendar['timeZone'])
         self.todayNode = todayNode
         self.tomorrowNode = tomorrowNode
+        self.startDate = None
+        self.syncToken = None
+        self.holidays = {}
+        self.fetchTomorrow = False
+        self.retry = False
+        self.updated = False
+        self.resync = False
 
 
 class DayNode(polyinterface.Node):
@@ -213,6 +507,7 @@ class DayNode(polyinterface.Node):
         super(DayNode, self).__init__(primary, controllerAddress, address, name)
         self.futureState = False
         self.currentDate = None
+        self.currentState = None
 
     def setDate(self, date):
         if self.currentDate != date:
@@ -232,7 +527,9 @@ class DayNode(polyinterface.Node):
             self.setState(False)
 
     def setState(self, state):
-        self.setDriver('ST', 1 if state else 0)
+        if self.currentState != state:
+            self.currentState = state
+            self.setDriver('ST', 1 if state else 0)
 
     def query(self):
         self.reportDrivers()